@@ -1,115 +1,426 @@
 #!/usr/bin/env python3
 
+import argparse
+import fcntl
 import ipaddress
 import json
+import logging
 import os
+import select
 import shutil
+import socket
 import subprocess
-from logging import info, error
+import time
+
+try:
+    from pyroute2 import IPRoute
+    from pyroute2.netlink.rtnl import RTMGRP_IPV6_IFADDR, RTMGRP_LINK
+except ImportError:
+    IPRoute = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+IFA_F_TENTATIVE = 0x40
+RT_SCOPE_UNIVERSE = 0
+LOOPBACK_PACKED = bytes(15) + b'\x01'
+
+IP_ENV = {'LC_ALL': 'C', 'PATH': '/usr/sbin:/sbin:/usr/bin:/bin'}
+IP_BIN = None
+if IPRoute is None:
+    IP_BIN = shutil.which('ip', path=IP_ENV['PATH'])
+    if IP_BIN is None:
+        raise ImportError('Neither pyroute2 nor the Unix tool \'ip\' is installed')
+
+logger = logging.getLogger(__name__)
+
+ipr = None
 
 def get_global_ipv6(interface):
     '''
-    Uses Unix 'ip' utility to get primary global system IPv6 address information
+    Uses a netlink socket to get the global system IPv6 addresses of an interface
 
     :param interface string: Name of the interface which IPv6 address should be returned
-    :returns dict: Return dict style in the -json notation of the 'ip' output
+    :returns list: List of dicts with the keys 'local', 'packed', 'prefixlen' and 'valid_life_time'
     '''
-    info('Checkinf if \'ip\' system utility is installed')
-    if shutil.which('ip') is None:
-        error('Unix tool \'ip\' is not installed')
+    if IPRoute is None:
+        return get_global_ipv6_ip(interface)
+    global ipr
+    if ipr is None:
+        logger.info('Opening netlink socket')
+        ipr = IPRoute()
+    indices = ipr.link_lookup(ifname=interface)
+    if not indices:
+        logger.error('Interface %s does not exist', interface)
         return None
-    info('Getting IPv6 output for global addresses from system')
+    logger.info('Getting global IPv6 addresses from kernel')
+    addresses = []
+    for msg in ipr.get_addr(family=socket.AF_INET6, index=indices[0]):
+        if msg['scope'] != RT_SCOPE_UNIVERSE or msg['flags'] & IFA_F_TENTATIVE:
+            continue
+        local = msg.get_attr('IFA_ADDRESS')
+        cacheinfo = msg.get_attr('IFA_CACHEINFO')
+        addresses.append({
+            'local': local,
+            'packed': socket.inet_pton(socket.AF_INET6, local),
+            'prefixlen': msg['prefixlen'],
+            'valid_life_time': cacheinfo['ifa_valid'] if cacheinfo else 0})
+    return addresses
+
+def get_global_ipv6_ip(interface):
+    '''
+    Uses Unix 'ip' utility to get the global system IPv6 addresses of an interface,
+    used when pyroute2 is not installed
+
+    :param interface string: Name of the interface which IPv6 address should be returned
+    :returns list: Same as get_global_ipv6
+    '''
+    logger.info('Getting IPv6 output for global addresses from system')
     output = subprocess.run([
-            'ip','-6','-json',
+            IP_BIN,'-6','-json',
             'address','show',
-            'dev',args.interface,
+            'dev',interface,
             'scope','global',
             '-tentative'],
-        capture_output=True)
+        capture_output=True, env=IP_ENV)
     if output.returncode != 0:
-        error('Error while running system \'ip\' utility')
-        error(output.stderr)   
+        logger.error('Error while running system \'ip\' utility')
+        logger.error(output.stderr)
         return None
-    return json.loads(output.stdout)
+    addresses = []
+    ipv6_info = orjson.loads(output.stdout) if orjson is not None else json.loads(output.stdout)
+    for link in ipv6_info:
+        for addr_info in link['addr_info']:
+            if addr_info == {}:
+                continue
+            addresses.append({
+                'local': addr_info['local'],
+                'packed': socket.inet_pton(socket.AF_INET6, addr_info['local']),
+                'prefixlen': addr_info['prefixlen'],
+                'valid_life_time': addr_info['valid_life_time']})
+    return addresses
 
-def docker_sys_prefix_same(docker_config_file, sys_ipv6_net):
+def load_docker_config(docker_config_file):
     '''
-    Compares prefix saved in the docker config and the prefix of the given IPv6
+    Loads the docker deamon config file
 
     :param docker_config_file string: Path to docker config file
-    :param sys_ipv6_net ipv6network: System IPv6 network
-    :returns boolean:
+    :returns dict: Parsed docker config
     '''
-    if not os.path.exists(docker_config_file):
-        error('Docker config file %s does not exist' %(docker_config_file))
+    try:
+        with open(docker_config_file, 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        logger.error('Docker config file %s does not exist', docker_config_file)
         return None
-    with open(docker_config_file, 'r') as f:
-        docker_config = json.load(f)
-    docker_ipv6_net = ipaddress.IPv6Network(docker_config['fixed-cidr-v6'])
-    if docker_ipv6_net.supernet() == sys_ipv6_net:
-        info('Provided supernet is the same as the subnet in the config')
-        return True
-    else:
-        info('Provided supernet is NOT the same as the subnet in the config')
-        return False
 
-def update_docker_prefix(docker_config_file, sys_ipv6_net):
+def last_subnet(ipv6_net, prefixlen_diff=1):
     '''
-    Updates the docker deamon config file with the provided sys_ipv6_net
+    Calculates the last subnet of a network without enumerating all subnets
+
+    :param ipv6_net ipv6network: Network to split
+    :param prefixlen_diff int: Amount the prefix length is increased by
+    :returns ipv6network: Last subnet of the network
+    '''
+    new_prefixlen = min(ipv6_net.prefixlen + prefixlen_diff, ipv6_net.max_prefixlen)
+    host_bits = ipv6_net.max_prefixlen - new_prefixlen
+    subnet_bits = new_prefixlen - ipv6_net.prefixlen
+    last = int(ipv6_net.network_address) | (((1 << subnet_bits) - 1) << host_bits)
+    return ipaddress.IPv6Network((last, new_prefixlen))
+
+def sync_docker_prefix(docker_config_file, sys_ipv6_net, lock_file):
+    '''
+    Writes the subnet derived from sys_ipv6_net to the docker deamon config if it differs
 
     :param docker_config_file string: Path to docker config file
     :param sys_ipv6_net ipv6network: System IPv6 network
-    :returns None:
+    :param lock_file string: Path to the file locked while the config is updated
+    :returns boolean: True if the config file was changed, None on error
     '''
-    if not os.path.exists(docker_config_file):
-        error('Docker config file %s does not exist' %(docker_config_file))
-        return None
-    with open(docker_config_file, 'r') as f:
-        docker_config = json.load(f)
-    *_, last_subnet = sys_ipv6_net.subnets()
-    docker_config['fixed-cidr-v6'] = str(last_subnet)
-    info('Writing new IPv6 prefix to docker config')
-    with open(docker_config_file, 'w') as f:
-        json.dump(docker_config, f, indent=4, sort_keys=True)
+    new_cidr = str(last_subnet(sys_ipv6_net))
+    # daemon.json is replaced on write, so the lock is held on a separate file
+    with open(lock_file, 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        docker_config = load_docker_config(docker_config_file)
+        if docker_config is None:
+            return None
+        if docker_config.get('fixed-cidr-v6') == new_cidr:
+            logger.info('Docker config already contains %s', new_cidr)
+            return False
+        logger.info('Writing new IPv6 subnet %s to docker config', new_cidr)
+        docker_config['fixed-cidr-v6'] = new_cidr
+        if not write_docker_config(docker_config_file, docker_config):
+            return None
+    return True
+
+def write_docker_config(docker_config_file, docker_config):
+    '''
+    Atomically replaces the docker deamon config file, so dockerd never reads a partial file.
+    The new file is validated by dockerd before it replaces the old one
+
+    :param docker_config_file string: Path to docker config file
+    :param docker_config dict: Docker config to write
+    :returns boolean: False if dockerd rejected the new config
+    '''
+    if orjson is not None:
+        data = orjson.dumps(docker_config, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+    else:
+        data = json.dumps(docker_config, indent=2, sort_keys=True).encode()
+    tmp_file = docker_config_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.copymode(docker_config_file, tmp_file)
+        if not validate_docker_config(tmp_file):
+            logger.error('Keeping the current docker config')
+            return False
+        os.replace(tmp_file, docker_config_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+    # Persist the rename itself, otherwise a power loss can still revert it
+    dir_fd = os.open(os.path.dirname(os.path.abspath(docker_config_file)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return True
+
+def validate_docker_config(docker_config_file):
+    '''
+    Lets dockerd validate the config file, skipped if dockerd is not installed
+    or too old to support --validate
+
+    :param docker_config_file string: Path to docker config file
+    :returns boolean: False if dockerd rejected the config
+    '''
+    dockerd = shutil.which('dockerd')
+    if dockerd is None:
+        logger.info('dockerd not found, skipping config validation')
+        return True
+    logger.info('Validating docker config')
+    output = subprocess.run([dockerd, '--validate', '--config-file', docker_config_file],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if output.returncode != 0 and b'unknown flag' in output.stderr:
+        logger.info('dockerd does not support --validate, skipping config validation')
+        return True
+    if output.returncode != 0:
+        logger.error('Docker config %s failed validation', docker_config_file)
+        logger.error(output.stderr)
+        return False
+    return True
 
 def restart_docker():
     '''
     Restarts docker daemon
 
-    :returns None:
+    fixed-cidr-v6 is not one of the options dockerd reloads on SIGHUP, so a
+    full restart is required to apply it.
+
+    :returns boolean: True if the restart succeeded
     '''
-    info('Restarting docker daemon')
-    output = subprocess.run(['systemctl','restart','docker'], capture_output=True)
+    logger.info('Restarting docker daemon')
+    output = subprocess.run(['systemctl','restart','docker'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
     if output.returncode != 0:
-        error('Error while restarting docker daemon')
-        error(output.stderr)   
-    else:
-        info('Docker daemon restarted successfully')
+        logger.error('Error while restarting docker daemon')
+        logger.error(output.stderr)
+        return False
+    logger.info('Docker daemon restarted successfully')
+    return True
+
+def debounce_remaining(stamp_file, debounce):
+    '''
+    Checks how long the debounce window of the last docker restart by this tool lasts
+
+    :param stamp_file string: Path to the file touched after every restart
+    :param debounce int: Debounce window in seconds
+    :returns float: Seconds until the window ends, 0 if it already has
+    '''
+    try:
+        mtime = os.stat(stamp_file).st_mtime
+    except FileNotFoundError:
+        return 0
+    remaining = mtime + debounce - time.time()
+    if remaining > 0:
+        logger.info('Docker was restarted less than %s seconds ago', debounce)
+        return remaining
+    return 0
+
+def touch_stamp(stamp_file):
+    '''
+    Creates the stamp file or updates its mtime to now
+
+    :param stamp_file string: Path to the stamp file
+    :returns None:
+    '''
+    with open(stamp_file, 'a'):
+        pass
+    os.utime(stamp_file)
 
-def check_private(ipv6):
+def check_private(packed):
     '''
-    Checks if an ip address is a private ip address
+    Checks if an ip address is a unique local, link local or loopback address
 
-    :param ipv6 string: ipv6 address
+    :param packed bytes: Packed ipv6 address
     :returns boolean:
     '''
-    info('Checks if reported global ipv6 address is private')
-    result = ipaddress.IPv6Address(ipv6).is_private
+    result = (packed[0] & 0xFE == 0xFC
+              or (packed[0] == 0xFE and packed[1] & 0xC0 == 0x80)
+              or packed == LOOPBACK_PACKED)
     if result:
-        info('Is private')
+        logger.info('Reported global ipv6 address is private')
     else:
-        info('Is not private')
+        logger.info('Reported global ipv6 address is not private')
     return result
 
-if __name__ == '__main__':
-    import argparse
-    import logging
+def select_ipv6_net(ipv6_info):
+    '''
+    Selects the network of the public address with the longest valid lifetime
 
+    :param ipv6_info list: Addresses as returned by get_global_ipv6
+    :returns ipv6network: System IPv6 network, None if there is no usable address
+    '''
+    best = None
+    if len(ipv6_info) == 1:
+        # Common case of a single global address, no lifetimes to compare
+        addr_info = ipv6_info[0]
+        if addr_info['valid_life_time'] > 0 and not check_private(addr_info['packed']):
+            best = addr_info
+    else:
+        validity = 0
+        for addr_info in ipv6_info:
+            if addr_info['valid_life_time'] <= validity:
+                continue
+            if check_private(addr_info['packed']):
+                continue
+            validity = addr_info['valid_life_time']
+            best = addr_info
+    if best is None:
+        return None
+    return ipaddress.IPv6Network(
+        (int.from_bytes(best['packed'], 'big'), best['prefixlen']), strict=False)
+
+def sync_prefix(args):
+    '''
+    Updates docker if the prefix of the interface no longer matches its config
+
+    :param args namespace: Parsed command line arguments
+    :returns boolean: True if done, False if the update was postponed, None on error
+    '''
+    if debounce_remaining(args.stampfile, args.debounce):
+        logger.info('Postponing the sync')
+        return False
+    ipv6_info = get_global_ipv6(args.interface)
+    if ipv6_info is None:
+        return None
+
+    sys_ipv6_net = select_ipv6_net(ipv6_info)
+    if not sys_ipv6_net:
+        logger.error('System has no usable IPv6 address')
+        return None
+
+    changed = sync_docker_prefix(args.dockerconfig, sys_ipv6_net, args.lockfile)
+    if changed is None:
+        return None
+    # Marks a written but not yet applied config, so a failed restart is retried
+    # even though the config already matches on the next run
+    pending_file = args.stampfile + '.pending'
+    if changed:
+        touch_stamp(pending_file)
+    elif os.path.exists(pending_file):
+        logger.info('Retrying the docker restart that failed earlier')
+    else:
+        return True
+    if not restart_docker():
+        return None
+    touch_stamp(args.stampfile)
+    os.remove(pending_file)
+    return True
+
+def monitor(args):
+    '''
+    Listens for IPv6 address changes on the interface and syncs the prefix after each burst.
+    Link events are followed as well, since a recreated interface (e.g. ppp0 after a
+    reconnect) keeps its name but gets a new index
+
+    :param args namespace: Parsed command line arguments
+    :returns None:
+    '''
+    if IPRoute is None:
+        logger.error('Daemon mode requires pyroute2')
+        return None
+    mon = IPRoute()
+    mon.bind(groups=RTMGRP_LINK | RTMGRP_IPV6_IFADDR)
+    indices = mon.link_lookup(ifname=args.interface)
+    ifindex = indices[0] if indices else None
+    if ifindex is None:
+        logger.warning('Interface %s does not exist yet, waiting for it', args.interface)
+    logger.info('Monitoring IPv6 addresses of %s', args.interface)
+
+    pending = ifindex is not None
+    deadline = time.monotonic()
+    while True:
+        timeout = max(0, deadline - time.monotonic()) if pending else None
+        ready, _, _ = select.select([mon], [], [], timeout)
+        if ready:
+            try:
+                msgs = mon.get()
+            except OSError:
+                # e.g. ENOBUFS when a burst overflows the socket, events may be lost
+                logger.exception('Error while receiving netlink events')
+                msgs = []
+                pending = True
+                deadline = time.monotonic() + args.quietperiod
+            for msg in msgs:
+                event = msg['event']
+                if event == 'RTM_NEWLINK' and msg.get_attr('IFLA_IFNAME') == args.interface:
+                    if msg['index'] == ifindex:
+                        continue
+                    logger.info('Interface %s now has index %s', args.interface, msg['index'])
+                    ifindex = msg['index']
+                elif event == 'RTM_DELLINK' and msg['index'] == ifindex:
+                    logger.info('Interface %s was removed', args.interface)
+                    ifindex = None
+                    continue
+                elif event not in ('RTM_NEWADDR', 'RTM_DELADDR') or msg['index'] != ifindex:
+                    continue
+                logger.info('Received %s for %s', event, args.interface)
+                pending = True
+                deadline = time.monotonic() + args.quietperiod
+            continue
+        try:
+            result = sync_prefix(args)
+        except Exception:
+            logger.exception('Error while syncing the IPv6 prefix')
+            result = None
+        if result is True:
+            pending = False
+        else:
+            # A postponed sync can run as soon as the debounce window of the last restart ends
+            delay = debounce_remaining(args.stampfile, args.debounce) if result is False else args.debounce
+            logger.info('Retrying the sync in %.0f seconds', delay)
+            deadline = time.monotonic() + delay
+
+if __name__ == '__main__':
     DOCKER_CONFIG_FILE = '/etc/docker/daemon.json'
+    STAMP_FILE = '/run/docker-dyn-ipv6.stamp'
+    LOCK_FILE = '/run/docker-dyn-ipv6.lock'
+    DEBOUNCE_SECS = 30
+    QUIET_PERIOD_SECS = 2
 
     parser = argparse.ArgumentParser(description='Tool to check if IPv6 prefix changed and update docker with the new one')
     parser.add_argument('-i', '--interface', required=True, help='Interface of which the IPv6 prefix should be taken')
-    parser.add_argument('-d', '--dockerconfig', default=DOCKER_CONFIG_FILE, help='Path to the docker deamon config: Default %s' %(DOCKER_CONFIG_FILE))
+    parser.add_argument('-d', '--dockerconfig', default=DOCKER_CONFIG_FILE, help=f'Path to the docker deamon config: Default {DOCKER_CONFIG_FILE}')
+    parser.add_argument('-s', '--stampfile', default=STAMP_FILE, help=f'File recording the last docker restart: Default {STAMP_FILE}')
+    parser.add_argument('-lk', '--lockfile', default=LOCK_FILE, help=f'File locked while the docker config is updated: Default {LOCK_FILE}')
+    parser.add_argument('-db', '--debounce', type=int, default=DEBOUNCE_SECS, help=f'Minimum seconds between docker restarts: Default {DEBOUNCE_SECS}')
+    parser.add_argument('-D', '--daemon', action='store_true', help='Keep running and react to address changes of the interface')
+    parser.add_argument('-qp', '--quietperiod', type=float, default=QUIET_PERIOD_SECS, help=f'Seconds without address changes before syncing in daemon mode: Default {QUIET_PERIOD_SECS}')
     parser.add_argument('-li', '--loginfo', action='store_true', help='If set also logs info messages')
     parser.add_argument('-lf', '--logfile', help='File to log into')
     args = parser.parse_args()
@@ -127,22 +438,9 @@ if __name__ == '__main__':
         fileh.setFormatter(log_formatter)
         logging.getLogger().addHandler(fileh)
 
-    ipv6_info = get_global_ipv6(args.interface)
-    if ipv6_info is None:
+    if args.daemon:
+        monitor(args)
         exit(1)
 
-    validity = 0
-    for addr_info in ipv6_info[0]['addr_info']:
-        if addr_info == {} or check_private(addr_info['local']):
-            continue
-        if validity < addr_info['valid_life_time']:
-            validity = addr_info['valid_life_time']
-            sys_ipv6_net = ipaddress.IPv6Network('%s/%s' %(addr_info['local'], addr_info['prefixlen']), strict=False)
-
-    if not sys_ipv6_net:
-        error('System has no usable IPv6 address')
+    if sync_prefix(args) is None:
         exit(1)
-
-    if not docker_sys_prefix_same(args.dockerconfig, sys_ipv6_net):
-        update_docker_prefix(args.dockerconfig, sys_ipv6_net)
-        restart_docker()
\ No newline at end of file